@@ -1,15 +1,23 @@
 # frontend.py
 
 import os
-import json
-import pandas as pd
+import re
+import orjson
+import asyncio
+import hashlib
 import google.generativeai as genai
 from datetime import date
-import time
 import streamlit as st
-from supabase import create_client, Client
 from dotenv import load_dotenv
 import io
+import mimetypes
+from itertools import islice
+from typing import TYPE_CHECKING
+
+# pandas, supabase and httpx are imported lazily where they are used, so the
+# first render of the page does not wait on them
+if TYPE_CHECKING:
+    from supabase import Client
 
 # --- INITIALIZATION AND CONFIGURATION ---
 
@@ -45,87 +53,391 @@ def check_credentials():
 # Call the check at the start of the script
 check_credentials()
 
-# Initialize Supabase client and configure Gemini
-sb: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-genai.configure(api_key=API_KEY)
+# Configure Gemini once per server process; calling genai.configure again on
+# every rerun would throw away the SDK's clients and their open connections.
+# Only the sync clients are used (from worker threads), so sharing them across
+# reruns is safe; the async clients are tied to a single event loop.
+@st.cache_resource
+def configure_gemini():
+    genai.configure(api_key=API_KEY)
+
+configure_gemini()
 
 # --- BACKEND LOGIC (Adapted from version1.py) ---
 
-def get_prompt_for_extraction():
+# This detailed prompt tells Gemini exactly what to do: transcribe the audio
+# and extract specific information into a structured JSON format.
+# It is sent as the model's system instruction so every request shares the
+# same prefix and only the audio varies between calls.
+EXTRACTION_PROMPT = """
+You are a highly accurate data entry assistant for a veterinary clinic.
+Your task is to listen to the provided audio files, each of which is a doctor's
+dictation, and extract the following specific pieces of information from each one.
+Every audio file is preceded by a label of the form "File <number>: <file name>".
+
+Format your response ONLY as a single, clean JSON array containing exactly one
+object per audio file. Do not include any other text, explanations, or markdown
+formatting like ```json.
+
+Each JSON object must have these exact keys:
+- "file_index"
+- "patient_id"
+- "patient_name"
+- "patient_dose"
+- "notes_for_doctor"
+
+Instructions for extraction:
+1.  **file_index**: The number from the label of the audio file this object describes, as an integer. Never combine information from different audio files in one object.
+2.  **patient_id**: Extract the value associated with "Paws ID". It should be a string of digits.
+3.  **patient_name**: Extract the value associated with "Cat name" or "Dog name".
+4.  **patient_dose**: This is critical. Combine all medications and their dosages into a single string. Separate each medication with a comma and a space. For example: "Augmentin injection 2cc, Neural fort 1cc".
+5.  **notes_for_doctor**: Extract any text that is a reminder, instruction, or observation for other staff. This often starts with "reminder for..." or "please give...". Include the full instruction.
+
+If any piece of information is not mentioned in the audio, use the value "N/A".
+"""
+
+# --- Cached clients, created once per server process and reused across reruns ---
+@st.cache_resource
+def get_supabase() -> "Client":
     """
-    This detailed prompt tells Gemini exactly what to do: transcribe the audio
-    and extract specific information into a structured JSON format.
+    Returns the shared Supabase client. Requests go through a pooled HTTP/2
+    client so keep-alive connections are reused between inserts.
     """
-    return """
-    You are a highly accurate data entry assistant for a veterinary clinic.
-    Your task is to listen to the provided audio file, which is a doctor's dictation,
-    and extract the following specific pieces of information.
+    import httpx
+    from supabase import create_client, ClientOptions
 
-    Format your response ONLY as a single, clean JSON object. Do not include any
-    other text, explanations, or markdown formatting like ```json.
+    http_client = httpx.Client(
+        http2=True,
+        timeout=30,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+    )
+    return create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(httpx_client=http_client))
 
-    The JSON object must have these exact keys:
-    - "patient_id"
-    - "patient_name"
-    - "patient_dose"
-    - "notes_for_doctor"
+@st.cache_resource
+def get_gemini_model() -> genai.GenerativeModel:
+    """Returns the shared Gemini model configured with the extraction prompt."""
+    return genai.GenerativeModel(
+        'models/gemini-2.5-flash',
+        system_instruction=EXTRACTION_PROMPT,
+        generation_config={"response_mime_type": "application/json"},
+    )
 
-    Instructions for extraction:
-    1.  **patient_id**: Extract the value associated with "Paws ID". It should be a number.
-    2.  **patient_name**: Extract the value associated with "Cat name" or "Dog name".
-    3.  **patient_dose**: This is critical. Combine all medications and their dosages into a single string. Separate each medication with a comma and a space. For example: "Augmentin injection 2cc, Neural fort 1cc".
-    4.  **notes_for_doctor**: Extract any text that is a reminder, instruction, or observation for other staff. This often starts with "reminder for..." or "please give...". Include the full instruction.
+# Matches the outermost JSON array or object in a Gemini response; only used
+# when the response is not bare JSON (e.g. wrapped in markdown fences)
+_JSON_RE = re.compile(rb'[\[{].*[\]}]', re.S)
 
-    If any piece of information is not mentioned in the audio, use the value "N/A".
+def parse_json_response(text):
     """
+    Parses a Gemini response as JSON. The whole text is tried first, falling
+    back to the outermost array or object found inside it.
+    """
+    raw = text.encode()
+    try:
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        pass
+
+    match = _JSON_RE.search(raw)
+    if match is None:
+        raise Exception("No JSON found in the response.")
+    return orjson.loads(match.group(0))
+
+# Upper bound on Gemini API calls (uploads, state polls and generate_content
+# requests) in flight at once, to stay within API rate limits
+MAX_CONCURRENT_REQUESTS = 8
 
-def process_audio_file(uploaded_file, model):
+# Number of audio files sent together in a single generate_content request
+AUDIO_BATCH_SIZE = 4
+
+def audio_mime_type(uploaded_file):
     """
-    Uploads a single audio file to the Gemini API and asks for data extraction.
-    Includes retry logic for API stability.
+    Returns the MIME type to upload an audio file with. Browsers often report
+    "", application/octet-stream or nothing useful for m4a and opus files, so
+    anything other than an audio/* type falls back to a guess from the name.
     """
+    if uploaded_file.type and uploaded_file.type.startswith("audio/"):
+        return uploaded_file.type
+
+    guessed_type = mimetypes.guess_type(uploaded_file.name)[0]
+    if guessed_type:
+        return guessed_type
+
+    raise Exception(f"Could not determine the audio type of {uploaded_file.name}.")
+
+async def upload_audio_file_async(uploaded_file, semaphore):
+    """
+    Uploads a single audio file to the Gemini API and waits until it is ready.
+    Blocking SDK calls run in worker threads so several files can be in flight.
+    Failed uploads are retried; returns None if every attempt fails.
+    """
+    try:
+        mime_type = audio_mime_type(uploaded_file)
+    except Exception as e:
+        st.error(str(e))
+        return None
+
     max_retries = 3
     for attempt in range(max_retries):
         try:
-            # Save the uploaded file temporarily to disk to get a path
-            with open(uploaded_file.name, "wb") as f:
-                f.write(uploaded_file.getbuffer())
-            
-            # Upload the file to Gemini
-            audio_file = genai.upload_file(path=uploaded_file.name)
-            
-            # Wait for processing
+            # Upload the in-memory audio bytes to Gemini, no temporary file needed
+            async with semaphore:
+                audio_file = await asyncio.to_thread(
+                    genai.upload_file,
+                    path=io.BytesIO(uploaded_file.getbuffer()),
+                    mime_type=mime_type,
+                    display_name=uploaded_file.name,
+                )
+
+            # Wait for processing, backing off from 0.25s up to 2s between polls
+            delay = 0.25
             while audio_file.state.name == "PROCESSING":
-                time.sleep(2)
-                audio_file = genai.get_file(audio_file.name)
-            
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 2.0)
+                async with semaphore:
+                    audio_file = await asyncio.to_thread(genai.get_file, audio_file.name)
+
             if audio_file.state.name == "FAILED":
                  raise Exception("File processing failed.")
 
-            # Send to Gemini for analysis
-            response = model.generate_content([get_prompt_for_extraction(), audio_file])
-            
-            # Clean up the response to ensure it's valid JSON
-            cleaned_response = response.text.strip().replace("```json", "").replace("```", "").strip()
-            
-            # Clean up the temporary file
-            os.remove(uploaded_file.name)
-            
-            return json.loads(cleaned_response)
+            return audio_file
+
+        except Exception as e:
+            st.warning(f"Upload attempt {attempt + 1} failed for {uploaded_file.name}: {e}")
+            if attempt < max_retries - 1:
+                await asyncio.sleep(min(2 ** (attempt + 1), 10))
+            else:
+                st.error(f"All upload retries failed for {uploaded_file.name}.")
+                return None
+
+def match_records_to_files(extracted, file_count):
+    """
+    Orders the records from a Gemini response by their "file_index" so each
+    one lines up with the labelled audio file it came from. Raises if any
+    file is missing, duplicated or unknown, since a record attached to the
+    wrong file would put a dose on the wrong patient.
+    """
+    if not isinstance(extracted, list) or not all(isinstance(item, dict) for item in extracted):
+        raise Exception("Expected a JSON array of objects in the response.")
+
+    by_index = {}
+    for item in extracted:
+        index = item.get("file_index")
+        if isinstance(index, str) and index.strip().isdigit():
+            index = int(index)
+        if isinstance(index, bool) or not isinstance(index, int) or not 1 <= index <= file_count:
+            raise Exception(f"Unexpected file_index {index!r} in the response.")
+        if index in by_index:
+            raise Exception(f"Duplicate file_index {index} in the response.")
+        by_index[index] = item
+
+    if len(by_index) != file_count:
+        missing = sorted(set(range(1, file_count + 1)) - set(by_index))
+        raise Exception(f"No record for file_index {missing} in the response.")
+
+    return [by_index[index] for index in range(1, file_count + 1)]
+
+async def extract_batch_async(uploads, model, semaphore):
+    """
+    Asks Gemini to extract the data for already-uploaded audio files in one
+    request. `uploads` is a list of (uploaded_file, audio_file) pairs. Returns
+    one result per pair, in order, or None if every attempt fails. Only the
+    generate_content call is retried; the files are never re-uploaded.
+    """
+    file_names = ", ".join(uploaded_file.name for uploaded_file, _ in uploads)
+
+    # Label every audio part so each result can be matched to its file by index
+    # rather than by its position in the response
+    contents = []
+    for index, (uploaded_file, audio_file) in enumerate(uploads, start=1):
+        contents.append(f"File {index}: {uploaded_file.name}")
+        contents.append(audio_file)
+
+    max_retries = 3
+    for attempt in range(max_retries):
+        try:
+            # Send to Gemini for analysis. The sync call runs in a worker thread
+            # because the model is cached for the whole process, and the SDK's
+            # async gRPC client is bound to the event loop that first used it
+            async with semaphore:
+                response = await asyncio.to_thread(model.generate_content, contents)
+
+            extracted = parse_json_response(response.text)
+
+            # A single file may come back as a bare object instead of an array,
+            # and with only one file there is nothing to mix up if it omits its index
+            if len(uploads) == 1:
+                if isinstance(extracted, dict):
+                    extracted = [extracted]
+                if isinstance(extracted, list) and len(extracted) == 1 and isinstance(extracted[0], dict):
+                    extracted[0].setdefault("file_index", 1)
+
+            return match_records_to_files(extracted, len(uploads))
 
         except Exception as e:
-            st.warning(f"Attempt {attempt + 1} failed for {uploaded_file.name}: {e}")
+            st.warning(f"Attempt {attempt + 1} failed for {file_names}: {e}")
             if attempt < max_retries - 1:
-                time.sleep(5)
+                await asyncio.sleep(min(2 ** (attempt + 1), 10))
             else:
-                st.error(f"All retries failed for {uploaded_file.name}.")
-                # Clean up the temporary file on failure
-                if os.path.exists(uploaded_file.name):
-                    os.remove(uploaded_file.name)
+                st.error(f"All retries failed for {file_names}.")
                 return None
 
+async def process_audio_batch_async(uploaded_files, model, semaphore):
+    """
+    Uploads a batch of audio files once and asks Gemini to extract the data
+    for all of them in one request. Returns one result per file, in order,
+    with None for files that could not be processed. If a multi-file request
+    keeps failing, the files are retried one per request using the same
+    uploaded handles.
+    """
+    audio_files = await asyncio.gather(*(upload_audio_file_async(file, semaphore) for file in uploaded_files))
+    positions = [i for i, audio_file in enumerate(audio_files) if audio_file is not None]
+    uploads = [(uploaded_files[i], audio_files[i]) for i in positions]
+
+    results = [None] * len(uploaded_files)
+    if not uploads:
+        return results
+
+    extracted = await extract_batch_async(uploads, model, semaphore)
+    if extracted is None and len(uploads) > 1:
+        # Fall back to one request per file so a single bad recording does not sink the batch
+        singles = await asyncio.gather(*(extract_batch_async([upload], model, semaphore) for upload in uploads))
+        extracted = [single[0] if single else None for single in singles]
+
+    if extracted is not None:
+        for i, extracted_data in zip(positions, extracted):
+            results[i] = extracted_data
+    return results
+
+async def process_all_audio_files(uploaded_files, model, status):
+    """
+    Processes all uploaded files in concurrent batches and returns the
+    extracted data in the same order as the uploads. Progress is reported on
+    the given status container as each batch finishes.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    completed = 0
+
+    async def run(batch):
+        nonlocal completed
+        extracted = await process_audio_batch_async(batch, model, semaphore)
+        completed += len(batch)
+        status.update(label=f"Processed {completed} of {len(uploaded_files)} file(s)...")
+        status.write(f"Finished {', '.join(file.name for file in batch)}")
+        return extracted
+
+    batches = [uploaded_files[i:i + AUDIO_BATCH_SIZE] for i in range(0, len(uploaded_files), AUDIO_BATCH_SIZE)]
+    results = await asyncio.gather(*(run(batch) for batch in batches))
+    return [extracted_data for batch_results in results for extracted_data in batch_results]
+
+def normalize_patient_id(value):
+    """
+    Returns the patient ID as text exactly as extracted, or None when it is
+    missing. Empty values and the prompt's "N/A" marker both become NULL, so
+    a missing ID is always stored the same way.
+    """
+    if value is None:
+        return None
+
+    patient_id = str(value).strip()
+    if not patient_id or patient_id.upper() == "N/A":
+        return None
+    return patient_id
+
+# PostgREST rejects very large request bodies, so bulk inserts are chunked
+SUPABASE_INSERT_BATCH_SIZE = 500
+
+def insert_records(records):
+    """
+    Inserts all records into Supabase using one bulk request per batch.
+    If a batch fails, its rows are retried one at a time so the offending
+    record can be identified. Returns the records that were inserted.
+    Rows are inserted with returning="minimal" because the records are
+    already held locally, so PostgREST does not need to echo them back.
+    """
+    table = get_supabase().schema(SUPABASE_SCHEMA).table("veterinary_records")
+    inserted = []
+    rows = iter(records)
+    while batch := list(islice(rows, SUPABASE_INSERT_BATCH_SIZE)):
+        try:
+            table.insert(batch, returning="minimal").execute()
+            inserted.extend(batch)
+            continue
+        except Exception as e:
+            st.warning(f"Bulk insert failed, retrying rows individually: {e}")
+
+        for record in batch:
+            try:
+                table.insert(record, returning="minimal").execute()
+                inserted.append(record)
+            except Exception as e:
+                st.error(f"❌ Error inserting record for patient {record.get('patient_id')} into Supabase: {str(e)}")
+    return inserted
+
+# Supabase column names mapped to the headings shown in the results table
+DISPLAY_COLUMNS = {
+    'patient_id': 'Patient ID',
+    'patient_name': 'Patient Name',
+    'patient_dose': 'Patient Dose',
+    'notes': 'Notes for Doctor',
+    'record_date': 'Date',
+}
+
 # --- STREAMLIT FRONTEND ---
 
+# The preview and results sections are fragments, so toggling a preview or
+# clicking a download button reruns only that section instead of the script
+
+@st.cache_data
+def convert_df_to_excel(df):
+    output = io.BytesIO()
+    df.to_excel(output, index=False, engine='xlsxwriter')
+    output.seek(0)
+    return output.getvalue()
+
+@st.cache_data
+def convert_df_to_csv(df):
+    return df.to_csv(index=False).encode('utf-8')
+
+@st.fragment
+def upload_preview_section(uploaded_files):
+    """Shows a preview toggle for each uploaded audio file."""
+    # Only render audio players on demand; each one embeds the full file in the page
+    for file in uploaded_files:
+        if st.checkbox(f"Preview {file.name}", key=f"preview_{file.file_id}"):
+            st.audio(file, format=file.type)
+
+@st.fragment
+def results_section(all_records):
+    """Shows the extracted records with Excel and CSV download buttons."""
+    import pandas as pd
+
+    st.header("3. Extracted Records")
+
+    # Build the table in display order, then relabel the columns in place
+    final_df = pd.DataFrame(all_records, columns=list(DISPLAY_COLUMNS))
+    final_df.columns = list(DISPLAY_COLUMNS.values())
+
+    st.dataframe(final_df, use_container_width=True)
+
+    # Provide download buttons for the results as Excel and CSV files
+    excel_col, csv_col = st.columns(2)
+    with excel_col:
+        st.download_button(
+            label="📥 Download Results as Excel",
+            data=convert_df_to_excel(final_df),
+            file_name="veterinary_records.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
+    with csv_col:
+        st.download_button(
+            label="📄 Download Results as CSV",
+            data=convert_df_to_csv(final_df),
+            file_name="veterinary_records.csv",
+            mime="text/csv"
+        )
+
+    st.warning("Always double-check the extracted dosages and patient information against the source audio.", icon="⚠️")
+
 st.set_page_config(page_title="Veterinary Audio Processor", layout="wide")
 
 st.title("🐾 Veterinary Audio Record Processor")
@@ -142,86 +454,79 @@ uploaded_files = st.file_uploader(
 
 if uploaded_files:
     st.success(f"Successfully uploaded {len(uploaded_files)} file(s).")
-    for file in uploaded_files:
-        st.audio(file, format=file.type)
+    upload_preview_section(uploaded_files)
 
 # Processing Button and Logic
 st.header("2. Process and View Results")
 if st.button("✨ Process Audio Files", type="primary", disabled=not uploaded_files):
     
-    # Use Gemini 1.5 Pro model
-    model = genai.GenerativeModel('models/gemini-2.5-flash')
-    
     all_records = []
-    
-    progress_bar = st.progress(0, text="Starting processing...")
-
-    for i, file in enumerate(uploaded_files):
-        progress_text = f"Processing file: {file.name}..."
-        progress_bar.progress((i + 1) / len(uploaded_files), text=progress_text)
-        
-        with st.spinner(progress_text):
-            extracted_data = process_audio_file(file, model)
-        
+
+    # Extracted data is kept per audio content hash for the session, so files
+    # that were already processed (or are uploaded twice) skip Gemini entirely
+    extraction_cache = st.session_state.setdefault("extraction_cache", {})
+    file_hashes = [hashlib.blake2b(file.getbuffer(), digest_size=16).hexdigest() for file in uploaded_files]
+    pending_files = {}
+    for file, file_hash in zip(uploaded_files, file_hashes):
+        if file_hash not in extraction_cache:
+            pending_files.setdefault(file_hash, file)
+
+    if pending_files:
+        model = get_gemini_model()
+        with st.status(f"Processing {len(pending_files)} file(s)...", expanded=True) as status:
+            pending_results = asyncio.run(process_all_audio_files(list(pending_files.values()), model, status))
+            status.update(label="Processing complete.", state="complete")
+
+        for file_hash, extracted_data in zip(pending_files, pending_results):
+            if extracted_data:
+                extraction_cache[file_hash] = extracted_data
+
+    reused_count = len(uploaded_files) - len(pending_files)
+    if reused_count:
+        st.info(f"Reused earlier results for {reused_count} file(s) with identical audio.")
+
+    results = [extraction_cache.get(file_hash) for file_hash in file_hashes]
+
+    # All records in a batch share the same date
+    today_str = date.today().isoformat()
+
+    # Records are saved to Supabase once per audio content hash for the session,
+    # so clicking Process again to retry failed files does not duplicate rows
+    inserted_hashes = st.session_state.setdefault("inserted_hashes", set())
+    records_to_insert = {}
+
+    for file, file_hash, extracted_data in zip(uploaded_files, file_hashes, results):
         if extracted_data:
-            # Patient ID may come as string; coerce safely to int when possible
-            raw_patient_id = extracted_data.get("patient_id", 0)
-            try:
-                patient_id_value = int(raw_patient_id)
-            except Exception:
-                patient_id_value = 0
+            patient_id = normalize_patient_id(extracted_data.get("patient_id"))
+            if patient_id is None:
+                st.warning(f"No Paws ID found in {file.name}; saved without a patient ID.")
 
             record = {
-                "patient_id": patient_id_value,
+                "patient_id": patient_id,
                 "patient_name": extracted_data.get("patient_name", "N/A"),
                 "patient_dose": extracted_data.get("patient_dose", "N/A"),
                 "notes": extracted_data.get("notes_for_doctor", extracted_data.get("notes", "N/A")),
-                "record_date": date.today().strftime('%Y-%m-%d'),
+                "record_date": today_str,
             }
-            try:
-                sb.schema(SUPABASE_SCHEMA).table("veterinary_records").insert(record).execute()
-                st.write(f"✅ Success: Data inserted into Supabase for {file.name}.")
-            except Exception as e:
-                st.error(f"❌ Error inserting into Supabase for {file.name}: {str(e)}")
             all_records.append(record)
+            if file_hash not in inserted_hashes:
+                records_to_insert.setdefault(file_hash, record)
         else:
             st.error(f"❌ Failed: Could not process {file.name}.")
 
-    progress_bar.empty()
-
     if all_records:
-        st.header("3. Extracted Records")
-        
-        df = pd.DataFrame(all_records)
-        
-        # Rename and reorder columns for display
-        final_df = df.rename(columns={
-            'patient_id': 'Patient ID',
-            'patient_name': 'Patient Name',
-            'patient_dose': 'Patient Dose',
-            'notes': 'Notes for Doctor',
-            'record_date': 'Date'
-        })
-        final_df = final_df[['Patient ID', 'Patient Name', 'Patient Dose', 'Notes for Doctor', 'Date']]
-        
-        st.dataframe(final_df, use_container_width=True)
-        
-        # Provide a download button for the results as an Excel file
-        @st.cache_data
-        def convert_df_to_excel(df):
-            output = io.BytesIO()
-            df.to_excel(output, index=False, engine='openpyxl')
-            output.seek(0)
-            return output.getvalue()
-
-        excel_data = convert_df_to_excel(final_df)
-        st.download_button(
-            label="📥 Download Results as Excel",
-            data=excel_data,
-            file_name="veterinary_records.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
-        
-        st.warning("Always double-check the extracted dosages and patient information against the source audio.", icon="⚠️")
+        if records_to_insert:
+            with st.spinner("Saving records to Supabase..."):
+                inserted = insert_records(list(records_to_insert.values()))
+            inserted_ids = {id(record) for record in inserted}
+            inserted_hashes.update(file_hash for file_hash, record in records_to_insert.items() if id(record) in inserted_ids)
+            if inserted:
+                st.write(f"✅ Success: {len(inserted)} of {len(records_to_insert)} new record(s) inserted into Supabase.")
+
+        already_saved_count = len(all_records) - len(records_to_insert)
+        if already_saved_count:
+            st.info(f"{already_saved_count} record(s) were already saved to Supabase for identical audio and were not inserted again.")
+
+        results_section(all_records)
     else:
         st.info("No data was successfully extracted from the uploaded files.")
\ No newline at end of file